@@ -4,30 +4,40 @@ FIXED Integrated LangChain + Transform Service for zkEngine
 Fixed WAT generation for custom proofs
 """
 
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Union, Tuple
+from typing import List, Optional, Dict, Any, Union, Tuple, AsyncIterator
 import os
 import re
+import asyncio
 import subprocess
-import tempfile
 import uuid
 from datetime import datetime
-import json
 import random
 import shutil
+import contextlib
+import functools
+import hashlib
+import weakref
 
-from langchain_openai import ChatOpenAI
+import aiofiles
+import anyio
+import orjson
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+
+# langchain_openai (and the openai client under it) is imported in get_llm(), on first use
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.output_parsers import PydanticOutputParser
-from langchain.memory import ConversationBufferMemory
-from langchain.schema import SystemMessage, HumanMessage, AIMessage
-from langchain.chains import LLMChain
-from langchain.schema.runnable import RunnablePassthrough
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.schema import messages_from_dict, messages_to_dict
 
-app = FastAPI(title="zkEngine Integrated Service - FIXED WAT Generation")
+app = FastAPI(
+    title="zkEngine Integrated Service - FIXED WAT Generation",
+    default_response_class=ORJSONResponse
+)
 
 # Enable CORS
 app.add_middleware(
@@ -88,18 +98,262 @@ api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     print("WARNING: OPENAI_API_KEY not found in environment variables!")
 
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.7,
-    api_key=api_key
-)
+@functools.lru_cache(maxsize=None)
+def get_llm():
+    """Create the shared chat model on first use, so workers that never call the LLM skip its HTTP client"""
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.7,
+        api_key=api_key
+    )
+
+# Build the LLM client and chains at startup instead of on the first chat request
+LLM_PRELOAD = os.getenv("LLM_PRELOAD", "").lower() in ("1", "true", "yes")
+
+# Bound on in-flight OpenAI requests per worker, to stay inside the account's RPM limits
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Created lazily by _get_llm_semaphore(): before Python 3.10 a semaphore binds to the
+# event loop current at construction, which at import is not the loop uvicorn serves on
+llm_semaphore: Optional[asyncio.Semaphore] = None
+_llm_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Directory zkEngine loads generated programs from
+WASM_DIR = os.path.expanduser('~/agentkit/zkengine/example_wasms')
+os.makedirs(WASM_DIR, exist_ok=True)
+
+# Conversation turns kept per session, and how long an idle session survives
+MEMORY_WINDOW_TURNS = 10
+SESSION_TTL_SECONDS = 3600
+MAX_SESSIONS = 10_000
+
+def render_messages(messages: List) -> bytes:
+    """Serialize chat messages in the history endpoint's format"""
+    return orjson.dumps([
+        {
+            "type": type(msg).__name__,
+            "content": msg.content
+        }
+        for msg in messages
+    ])
+
+class WindowedMemory(ConversationBufferWindowMemory):
+    """Window memory that also discards messages once they fall out of the window"""
+
+    # Serialized history for the history endpoint, dropped whenever the messages change
+    history_json: Optional[bytes] = None
+    # Raw Redis value the messages were last loaded from or written as
+    stored: Optional[bytes] = None
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        del self.chat_memory.messages[:-2 * self.k]
+        self.history_json = None
+
+    def set_messages(self, messages: List, stored: Optional[bytes] = None) -> None:
+        """Replace the history, e.g. with the copy held in Redis"""
+        self.chat_memory.messages = messages
+        self.stored = stored
+        self.history_json = None
+
+    def render_history(self) -> bytes:
+        """The message list as JSON bytes, serialized once per change"""
+        if self.history_json is None:
+            self.history_json = render_messages(self.chat_memory.messages)
+        return self.history_json
 
 # Memory storage per session
-memory_store: Dict[str, ConversationBufferMemory] = {}
+memory_store: TTLCache = TTLCache(maxsize=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS)
+
+# Per-session locks serializing each turn's load/respond/save cycle; an entry
+# disappears once no request holds its lock
+session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Optional shared session store, required when running more than one worker process
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_KEY_PREFIX = "zkengine:session:"
+# Kept apart from SESSION_KEY_PREFIX, which is followed by arbitrary session ids
+SESSION_LOCK_PREFIX = "zkengine:session-lock:"
+# Expiry of the cross-worker turn lock, so a crashed worker can't wedge a session;
+# a live turn renews it every third of this, however long the LLM takes
+SESSION_LOCK_TIMEOUT_SECONDS = 120
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+# /analyze results per normalized (concept, domain, language), kept in process
+# and, when Redis is configured, shared between workers and restarts
+ANALYSIS_CACHE_SIZE = 1024
+ANALYSIS_CACHE_TTL_SECONDS = 24 * 3600
+ANALYSIS_KEY_PREFIX = "zkengine:analysis:"
+analysis_cache: TTLCache = TTLCache(maxsize=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL_SECONDS)
+# Analyses currently being generated, so identical concurrent requests share one LLM call
+analysis_in_flight: Dict[str, "asyncio.Task[str]"] = {}
 
 # Streamlined system prompt (unchanged)
 SYSTEM_PROMPT = """You are an intelligent assistant for zkEngine, a zero-knowledge proof system..."""
 
+# Chat prompts, built once and shared by every request
+ENHANCED_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "{input}"),
+    ("system", """Analyze this request carefully. The user said: "{input}"
+
+ABSOLUTELY CRITICAL: 
+- Use ONLY plain text
+- NO markdown formatting whatsoever
+- NO asterisks, hashtags, backticks, underscores, or any other formatting symbols
+- Write everything as simple, clean plain text
+
+If they're asking for a proof (kyc, ai content, location), extract these details:
+- Function name
+- Arguments
+- Provide a rich explanation in the language they requested
+
+If they're asking for verification:
+- Acknowledge the verification request
+- Explain what proof verification means
+- Let them know the system will verify the proof
+- DO NOT say you cannot verify proofs
+
+Always provide a conversational, helpful response that addresses ALL aspects of their request.
+If they ask in a specific language, respond in that language (except technical terms).""")
+])
+
+CONVERSATION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT + "\n\nThe user is having a general conversation. Be helpful and conversational. Remember: NO markdown formatting whatsoever. Use only plain text."),
+    MessagesPlaceholder(variable_name="history"),
+    ("human", "{input}")
+])
+
+# /analyze prompt, shared by the JSON and streaming endpoints. The instructions are a
+# fixed system message and the request fields come last, so every call shares one prefix
+ANALYSIS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """Analyze the concept given by the user, focusing on the given domain.
+
+CRITICAL: Use ONLY plain text. NO markdown formatting. No asterisks, hashtags, backticks, or any other formatting.
+
+Provide:
+1. A clear explanation of the concept
+2. How it relates to zkEngine proofs and zero-knowledge systems
+3. Domain-specific insights
+4. Suggested proofs to demonstrate this concept
+5. Real-world applications and implications
+
+Make the analysis engaging and accessible while maintaining technical accuracy.
+If the response language is not English, provide the entire response in that language."""),
+    ("human", "Concept: {concept}\nDomain focus: {domain}\nResponse language: {language}")
+])
+
+@functools.lru_cache(maxsize=None)
+def get_chat_chain(analysis: bool):
+    """Pipe the matching chat prompt into the shared LLM, once per prompt"""
+    return (ENHANCED_PROMPT if analysis else CONVERSATION_PROMPT) | get_llm()
+
+@functools.lru_cache(maxsize=None)
+def get_analysis_chain():
+    """Pipe the /analyze prompt into the shared LLM, once"""
+    return ANALYSIS_PROMPT | get_llm()
+
+# ===== COMPILED PATTERNS =====
+
+# C source transforms. The rewrites are fused into one alternation so a single
+# re.sub pass handles them; main comes first so it wins over the plain type rewrite.
+# The leading lookahead rejects most positions on their first character.
+_RE_C_REWRITE = re.compile(
+    r'(?=[ifps])(?:'
+    r'(?P<main>(?:\bint|\bfloat|int32_t)\s+main\s*\([^)]*\))'
+    r'|(?P<type>\b(?:int|float)\s+)'
+    r'|(?P<printf>printf\s*\([^;]+\);)'
+    r'|(?P<scanf>scanf\s*\([^;]+\);)'
+    r')'
+)
+_C_REWRITES = {
+    'main': 'int32_t main()',
+    'type': 'int32_t ',
+    'printf': '/* printf removed */;',
+    'scanf': '/* scanf removed */;',
+}
+_RE_INCLUDE = re.compile(r'#include\s*<[^>]+>')
+_RE_MALLOC = re.compile(r'(\w+)\s*=\s*malloc\([^)]+\)')
+_RE_FREE = re.compile(r'free\s*\([^)]+\);')
+
+# Markdown cleanup of LLM responses: emphasis/heading/code characters are deleted,
+# then [text](url) links are reduced to their text (see _strip_md_links)
+_MARKDOWN_STRIP_CHARS = '*#`_'
+_MARKDOWN_STRIP_TABLE = str.maketrans('', '', _MARKDOWN_STRIP_CHARS)
+
+# Chat request classification (plain substring matches against the lowercased message)
+VERIFICATION_KEYWORDS = ["verify", "check", "validate"]
+LANGUAGE_KEYWORDS = [
+    "spanish", "español", "french", "français", "german", "deutsch",
+    "italian", "italiano", "portuguese", "português", "chinese", "中文",
+    "japanese", "日本語", "russian", "русский", "arabic", "عربي",
+    "persian", "farsi", "فارسی"
+]
+ANALYSIS_KEYWORDS = [
+    "explain", "market", "trends", "analysis", "significance",
+    "philosophy", "cultural", "economic", "business", "industry",
+    "what is", "tell me", "describe"
+]
+_RE_VERIFICATION = re.compile('|'.join(map(re.escape, VERIFICATION_KEYWORDS)))
+_RE_LANGUAGE = re.compile('|'.join(map(re.escape, LANGUAGE_KEYWORDS)))
+_RE_ANALYSIS = re.compile('|'.join(map(re.escape, ANALYSIS_KEYWORDS)))
+
+# Proof intent extraction
+LOCATION_CITIES = ['san francisco', 'sf', 'new york', 'nyc', 'london']
+_RE_CITY = re.compile('|'.join(map(re.escape, LOCATION_CITIES)))
+_RE_DEVICE = re.compile(r'device.*?(\d+)', re.IGNORECASE)
+
+_STEP_SIZE_PATTERNS = [
+    re.compile(r'(?:with\s+)?step\s+size\s+(\d+)', re.IGNORECASE),
+    re.compile(r'(?:using\s+)?(\d+)\s+step\s+size', re.IGNORECASE),
+    re.compile(r'step\s+(\d+)', re.IGNORECASE),
+]
+
+# Pattern matching for 3 main proof types (checked in order)
+PROOF_PATTERNS = {
+    'prove_kyc': [
+        r'prove\s+kyc\s+compliance',
+        r'kyc\s+compliance',
+        r'verify\s+kyc\s+status',
+        r'prove\s+kyc',
+        r'kyc\s+proof',
+        r'kyc\s+verification',
+        r'circle\s+kyc',
+        r'regulatory\s+compliance',
+        r'compliance\s+proof',
+        r'kyc\s+approved',
+        r'prove\s+compliance'
+    ],
+    'prove_ai_content': [
+        r'prove\s+ai\s+content\s+authenticity',
+        r'ai\s+content\s+authenticity',
+        r'verify\s+ai\s+content',
+        r'prove\s+content\s+authenticity',
+        r'ai\s+authenticity',
+        r'content\s+verification',
+        r'verify\s+ai\s+generated',
+        r'prove\s+ai\s+generated',
+        r'ai\s+content\s+proof',
+        r'authenticate\s+ai\s+content',
+        r'ai\s+content',
+        r'content\s+authenticity'
+    ]
+}
+
+# One alternation per proof type: a single scan per type, while keeping the
+# type priority above (a leftmost match across all types would not)
+_RE_PROOF_TYPES = {
+    func: re.compile('|'.join(f'(?:{pattern})' for pattern in func_patterns), re.IGNORECASE)
+    for func, func_patterns in PROOF_PATTERNS.items()
+}
+
+# Default arguments for each proof type
+DEFAULT_PROOF_ARGS = {
+    'prove_kyc': ["12345", "1"],  # wallet_hash=12345, kyc_approved=1
+    'prove_ai_content': ["42", "1"],  # content_hash=42, auth_type=1
+}
+
 # ===== TRANSFORM SERVICE FUNCTIONS =====
 
 def transform_for_zkengine(code: str) -> Tuple[str, List[str]]:
@@ -120,42 +374,51 @@ def transform_for_zkengine(code: str) -> Tuple[str, List[str]]:
                 code = '#include <stdint.h>\n\n' + code
             changes.append("Added #include <stdint.h>")
     
-    # Type conversions
-    code = re.sub(r'\bint\s+', 'int32_t ', code)
-    code = re.sub(r'\bfloat\s+', 'int32_t ', code)
-    changes.append("Converted int/float to int32_t")
+    # Type conversions, I/O removal and the main signature fix in one pass.
+    # Since values are now hardcoded, main doesn't need parameters
+    rewritten = set()
+    scanf_in_printf = 0
+    def rewrite(match):
+        nonlocal scanf_in_printf
+        kind = match.lastgroup
+        rewritten.add(kind)
+        if kind == 'printf':
+            scanf_in_printf += match.group().count('scanf')
+        return _C_REWRITES[kind]
     
-    # Remove I/O operations
-    if 'printf' in code:
-        code = re.sub(r'printf\s*\([^;]+\);', '/* printf removed */;', code)
+    has_printf = 'printf' in code
+    scanf_count = code.count('scanf')
+    code = _RE_C_REWRITE.sub(rewrite, code)
+    changes.append("Converted int/float to int32_t")
+    if has_printf:
         changes.append("Removed printf statements")
-    
-    if 'scanf' in code:
-        code = re.sub(r'scanf\s*\([^;]+\);', '/* scanf removed */;', code)
+    # A scanf that only appeared inside a removed printf doesn't count
+    if scanf_count > scanf_in_printf:
         changes.append("Removed scanf statements")
-    
-    # Fix main function for hardcoded values
-    # Since values are now hardcoded, main doesn't need parameters
-    main_match = re.search(r'int32_t\s+main\s*\([^)]*\)', code)
-    if main_match:
-        # Replace with parameterless main
-        code = re.sub(r'int32_t\s+main\s*\([^)]*\)', 'int32_t main()', code)
+    if 'main' in rewritten:
         changes.append("Fixed main signature for hardcoded values")
     
     # Convert malloc to stack allocations
     if 'malloc' in code:
         if '#define BUFFER_SIZE' not in code:
+            # Jump straight to the last include instead of walking all of them
             includes_end = 0
-            for match in re.finditer(r'#include\s*<[^>]+>', code):
+            include_pos = code.rfind('#include')
+            match = _RE_INCLUDE.match(code, include_pos) if include_pos >= 0 else None
+            if match:
                 includes_end = match.end()
+            else:
+                # The last include isn't a <...> one, so scan for the last one that is
+                for match in _RE_INCLUDE.finditer(code):
+                    includes_end = match.end()
             
             if includes_end > 0:
                 code = code[:includes_end] + '\n#define BUFFER_SIZE 1000\n' + code[includes_end:]
             else:
                 code = '#define BUFFER_SIZE 1000\n' + code
         
-        code = re.sub(r'(\w+)\s*=\s*malloc\([^)]+\)', r'\1 = (int32_t*)stack_buffer', code)
-        code = re.sub(r'free\s*\([^)]+\);', '/* free removed */;', code)
+        code = _RE_MALLOC.sub(r'\1 = (int32_t*)stack_buffer', code)
+        code = _RE_FREE.sub('/* free removed */;', code)
         
         main_start = code.find('{', code.find('main'))
         if main_start > 0:
@@ -165,29 +428,26 @@ def transform_for_zkengine(code: str) -> Tuple[str, List[str]]:
     
     return code, changes
 
-def generate_wat_from_c_analysis(code: str) -> str:
-    """Generate PROPER WAT that implements actual algorithms"""
-    
-    import re
-    
-    # Extract value from different patterns
-    def extract_value(code, var_names, func_name=None, default=0):
-        for var in var_names:
-            # Check for variable assignment
-            match = re.search(rf'{var}\s*=\s*(\d+)', code)
-            if match:
-                return int(match.group(1))
-            # Check for direct function call
-            if func_name:
-                match = re.search(rf'{func_name}\s*\(\s*(\d+)\s*\)', code)
-                if match:
-                    return int(match.group(1))
-        return default
-    
-    if 'is_prime' in code:
-        value = extract_value(code, ['number_to_check', 'n', 'num'], 'is_prime', 17)
-        
-        return f"""(module
+# ===== WAT GENERATION =====
+
+def _value_patterns(var_names: List[str], func_name: str) -> List[re.Pattern]:
+    """Patterns tried in order: first variable assignment, direct function call, remaining assignments"""
+    assignments = [re.compile(rf'{var}\s*=\s*(\d+)') for var in var_names]
+    call = re.compile(rf'{func_name}\s*\(\s*(\d+)\s*\)')
+    return assignments[:1] + [call] + assignments[1:]
+
+# Value extractors per algorithm
+_VALUE_PATTERNS = {
+    'is_prime': _value_patterns(['number_to_check', 'n', 'num'], 'is_prime'),
+    'collatz': _value_patterns(['starting_number', 'start', 'n'], 'collatz'),
+    'digital_root': _value_patterns(['input_number', 'num', 'n'], 'digital_root'),
+    'fibonacci': _value_patterns(['n', 'num', 'value'], 'fibonacci'),
+    'factorial': _value_patterns(['n', 'num', 'value'], 'factorial'),
+}
+_RE_GCD_A = re.compile(r'(?:a|x|first)\s*=\s*(\d+)')
+_RE_GCD_B = re.compile(r'(?:b|y|second)\s*=\s*(\d+)')
+
+_WAT_PRIME_TMPL = """(module
   ;; Prime checker for {value} - REAL ALGORITHM
   (func (export "main") (param $dummy i32) (result i32)
     (local $n i32)
@@ -233,11 +493,8 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (i32.const 1)
   )
 )"""
-    
-    elif 'collatz' in code.lower():
-        value = extract_value(code, ['starting_number', 'start', 'n'], 'collatz', 27)
-        
-        return f"""(module
+
+_WAT_COLLATZ_TMPL = """(module
   ;; Collatz sequence steps for {value} - REAL ALGORITHM
   (func (export "main") (param $dummy i32) (result i32)
     (local $n i32)
@@ -284,11 +541,8 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (local.get $steps)
   )
 )"""
-    
-    elif 'digital_root' in code or 'digit_sum' in code:
-        value = extract_value(code, ['input_number', 'num', 'n'], 'digital_root', 12345)
-        
-        return f"""(module
+
+_WAT_DIGITAL_ROOT_TMPL = """(module
   ;; Digital root calculator for {value} - REAL ALGORITHM
   (func (export "main") (param $dummy i32) (result i32)
     (local $n i32)
@@ -332,11 +586,8 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (local.get $n)
   )
 )"""
-    
-    elif 'fibonacci' in code:
-        value = extract_value(code, ['n', 'num', 'value'], 'fibonacci', 10)
-        
-        return f"""(module
+
+_WAT_FIBONACCI_TMPL = """(module
   ;; Fibonacci calculator for n={value} - ITERATIVE
   (func (export "main") (param $dummy i32) (result i32)
     (local $n i32)
@@ -376,11 +627,8 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (local.get $b)
   )
 )"""
-    
-    elif 'factorial' in code:
-        value = extract_value(code, ['n', 'num', 'value'], 'factorial', 5)
-        
-        return f"""(module
+
+_WAT_FACTORIAL_TMPL = """(module
   ;; Factorial calculator for n={value}
   (func (export "main") (param $dummy i32) (result i32)
     (local $n i32)
@@ -411,15 +659,8 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (local.get $result)
   )
 )"""
-    
-    elif 'gcd' in code or 'greatest_common' in code:
-        # Try to find two values
-        a_match = re.search(r'(?:a|x|first)\s*=\s*(\d+)', code)
-        b_match = re.search(r'(?:b|y|second)\s*=\s*(\d+)', code)
-        a = int(a_match.group(1)) if a_match else 48
-        b = int(b_match.group(1)) if b_match else 18
-        
-        return f"""(module
+
+_WAT_GCD_TMPL = """(module
   ;; GCD calculator for {a} and {b} - Euclidean algorithm
   (func (export "main") (param $dummy i32) (result i32)
     (local $a i32)
@@ -449,60 +690,111 @@ def generate_wat_from_c_analysis(code: str) -> str:
     (local.get $a)
   )
 )"""
-    
-    else:
-        # Default case - just return 42
-        print(f"No specific pattern detected in code. Using default.")
-        return """(module
+
+_WAT_DEFAULT = """(module
   ;; Default computation
   (func (export "main") (param $dummy i32) (result i32)
     i32.const 42
   )
 )"""
 
+def extract_value(code: str, algorithm: str, default: int) -> int:
+    """Extract the input value for an algorithm from C source, or fall back to default"""
+    for pattern in _VALUE_PATTERNS[algorithm]:
+        match = pattern.search(code)
+        if match:
+            return int(match.group(1))
+    return default
+
+@functools.lru_cache(maxsize=1024)
+def render_wat(template: str, **values: int) -> str:
+    """Fill a WAT template, reusing the result for repeated (template, values) pairs"""
+    return template.format(**values)
+
+def _emit_prime_wat(code: str) -> str:
+    return render_wat(_WAT_PRIME_TMPL, value=extract_value(code, 'is_prime', 17))
+
+def _emit_collatz_wat(code: str) -> str:
+    return render_wat(_WAT_COLLATZ_TMPL, value=extract_value(code, 'collatz', 27))
+
+def _emit_digital_root_wat(code: str) -> str:
+    return render_wat(_WAT_DIGITAL_ROOT_TMPL, value=extract_value(code, 'digital_root', 12345))
+
+def _emit_fibonacci_wat(code: str) -> str:
+    return render_wat(_WAT_FIBONACCI_TMPL, value=extract_value(code, 'fibonacci', 10))
+
+def _emit_factorial_wat(code: str) -> str:
+    return render_wat(_WAT_FACTORIAL_TMPL, value=extract_value(code, 'factorial', 5))
+
+def _emit_gcd_wat(code: str) -> str:
+    # Try to find two values
+    a_match = _RE_GCD_A.search(code)
+    b_match = _RE_GCD_B.search(code)
+    a = int(a_match.group(1)) if a_match else 48
+    b = int(b_match.group(1)) if b_match else 18
+    return render_wat(_WAT_GCD_TMPL, a=a, b=b)
+
+# (marker, emitter) pairs checked in priority order against the lowercased source
+_ALGO_DISPATCH = [
+    ('is_prime', _emit_prime_wat),
+    ('collatz', _emit_collatz_wat),
+    ('digital_root', _emit_digital_root_wat),
+    ('digit_sum', _emit_digital_root_wat),
+    ('fibonacci', _emit_fibonacci_wat),
+    ('factorial', _emit_factorial_wat),
+    ('gcd', _emit_gcd_wat),
+    ('greatest_common', _emit_gcd_wat),
+]
+
+def generate_wat_from_c_analysis(code: str) -> str:
+    """Generate PROPER WAT that implements actual algorithms"""
+    code_lower = code.lower()
+    for marker, emit in _ALGO_DISPATCH:
+        if marker in code_lower:
+            return emit(code)
+    
+    # Default case - just return 42
+    print(f"No specific pattern detected in code. Using default.")
+    return _WAT_DEFAULT
+
 async def compile_to_wasm(code: str, filename: str) -> Dict[str, Any]:
     """Compile transformed C code to WebAssembly TEXT format with REAL algorithms"""
     try:
         print(f"Generating proper WAT with real algorithms for {filename}")
         
-        # Generate proper WAT with real algorithm implementations
-        wat_content = generate_wat_from_c_analysis(code)
+        # Generate proper WAT with real algorithm implementations, off the event loop
+        loop = asyncio.get_running_loop()
+        wat_content = await loop.run_in_executor(None, generate_wat_from_c_analysis, code)
+        
+        # Name the file after a hash of the generated WAT, so resubmitting the same
+        # program reuses the file zkEngine already has, while a change to the
+        # generator always produces a new file
+        base_name = filename.replace('.c', '')
+        wat_hash = hashlib.blake2b(wat_content.encode(), digest_size=8).hexdigest()
+        final_wat_name = f"{base_name}_{wat_hash}.wat"
+        final_wat_path = os.path.join(WASM_DIR, final_wat_name)
+        
+        if not os.path.exists(final_wat_path):
+            # Write the WAT content into the zkEngine wasm directory. Concurrent
+            # compiles of the same source race here, so publish it atomically
+            tmp_path = f"{final_wat_path}.{uuid.uuid4().hex[:8]}.tmp"
+            async with aiofiles.open(tmp_path, 'w') as f:
+                await f.write(wat_content)
+            os.replace(tmp_path, final_wat_path)
+        
+        # Get file size
+        file_size = len(wat_content.encode('utf-8'))
+        
+        print(f"Generated WAT file: {final_wat_name} ({file_size} bytes)")
+        print(f"Algorithm detected and implemented with real logic")
+        
+        return {
+            'success': True,
+            'wat_content': wat_content,
+            'wasm_file': final_wat_name,
+            'wasm_size': file_size
+        }
         
-        # Create temporary directory for file operations
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Generate unique filename
-            base_name = filename.replace('.c', '')
-            unique_id = str(uuid.uuid4())[:8]
-            wat_file = os.path.join(tmpdir, f"{base_name}_{unique_id}.wat")
-            
-            # Write WAT content
-            with open(wat_file, 'w') as f:
-                f.write(wat_content)
-            
-            # Copy to zkEngine wasm directory
-            wasm_dir = os.path.expanduser('~/agentkit/zkengine/example_wasms')
-            os.makedirs(wasm_dir, exist_ok=True)
-            
-            final_wat_name = f"{base_name}_{unique_id}.wat"
-            final_wat_path = os.path.join(wasm_dir, final_wat_name)
-            
-            # Write the WAT content
-            with open(final_wat_path, 'w') as f:
-                f.write(wat_content)
-            
-            # Get file size
-            file_size = len(wat_content.encode('utf-8'))
-            
-            print(f"Generated WAT file: {final_wat_name} ({file_size} bytes)")
-            print(f"Algorithm detected and implemented with real logic")
-            
-            return {
-                'success': True,
-                'wat_content': wat_content,
-                'wasm_file': final_wat_name,
-                'wasm_size': file_size
-            }
-            
     except Exception as e:
         print(f"Error in compile_to_wasm: {e}")
         import traceback
@@ -514,13 +806,213 @@ async def compile_to_wasm(code: str, filename: str) -> Dict[str, Any]:
 
 # ===== LANGCHAIN FUNCTIONS (unchanged) =====
 
-def get_memory(session_id: str) -> ConversationBufferMemory:
-    if session_id not in memory_store:
-        memory_store[session_id] = ConversationBufferMemory(
+def _strip_md_links(text: str) -> str:
+    """Replace [text](url) links with their text, using str.find jumps instead of a regex"""
+    # Same matches as \[([^\]]+)\]\([^\)]+\): none of the character classes can contain
+    # their closing delimiter, so each '[' has at most one candidate match
+    parts = []
+    start = 0
+    pos = text.find('[')
+    while pos != -1:
+        close = text.find(']', pos + 1)
+        if close == -1:
+            # No later '[' can be closed either
+            break
+        if close > pos + 1 and text.startswith('(', close + 1):
+            end = text.find(')', close + 2)
+            if end == -1:
+                break
+            if end > close + 2:
+                parts.append(text[start:pos])
+                parts.append(text[pos + 1:close])
+                start = end + 1
+                pos = text.find('[', start)
+                continue
+        pos = text.find('[', pos + 1)
+    if not parts:
+        return text
+    parts.append(text[start:])
+    return ''.join(parts)
+
+def strip_markdown(text: str) -> str:
+    """Remove markdown formatting from an LLM response"""
+    # The model is told to answer in plain text, so most responses need neither
+    # step; substring checks are much cheaper than a regex probe for that
+    if any(c in text for c in _MARKDOWN_STRIP_CHARS):
+        text = text.translate(_MARKDOWN_STRIP_TABLE)
+    return _strip_md_links(text)
+
+def _link_holdback(text: str) -> int:
+    """Index from which text must be held back because a [text](url) link may still be streaming in"""
+    start = text.rfind('[')
+    if start == -1:
+        return len(text)
+    close = text.find(']', start)
+    if close == -1 or close + 1 == len(text):
+        return start
+    if text[close + 1] != '(' or text.find(')', close + 2) != -1:
+        return len(text)
+    return start
+
+async def stream_markdown_free(chunks) -> AsyncIterator[str]:
+    """Strip markdown from streamed LLM chunks as they arrive"""
+    pending = ''
+    async for chunk in chunks:
+        pending += chunk.content
+        cut = _link_holdback(pending)
+        text = strip_markdown(pending[:cut])
+        pending = pending[cut:]
+        if text:
+            yield text
+    if pending:
+        yield strip_markdown(pending)
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> bytes:
+    """Encode one server-sent event frame"""
+    frame = f"event: {event}\n" if event else ""
+    return (frame + "data: ").encode() + orjson.dumps(data) + b"\n\n"
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    """The LLM concurrency bound for the running event loop"""
+    global llm_semaphore, _llm_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if llm_semaphore is None or _llm_semaphore_loop is not loop:
+        llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _llm_semaphore_loop = loop
+    return llm_semaphore
+
+async def ainvoke_llm(runnable, payload):
+    """Await an LLM runnable without blocking the event loop, bounded by llm_semaphore"""
+    async with _get_llm_semaphore():
+        return await runnable.ainvoke(payload)
+
+async def astream_llm(runnable, payload):
+    """Stream an LLM runnable's chunks, bounded by llm_semaphore like ainvoke_llm"""
+    async with _get_llm_semaphore():
+        async for chunk in runnable.astream(payload):
+            yield chunk
+
+def get_memory(session_id: str) -> WindowedMemory:
+    memory = memory_store.get(session_id)
+    if memory is None:
+        memory = WindowedMemory(
+            k=MEMORY_WINDOW_TURNS,
             return_messages=True,
             memory_key="history"
         )
-    return memory_store[session_id]
+    # (Re)inserting restarts the idle timer for this session
+    memory_store[session_id] = memory
+    return memory
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    return lock
+
+async def keep_lock(lock) -> None:
+    """Push back a held Redis lock's expiry until cancelled"""
+    while True:
+        await asyncio.sleep(SESSION_LOCK_TIMEOUT_SECONDS / 3)
+        try:
+            await lock.reacquire()
+        except LockError as e:
+            print(f"Lost session lock {lock.name}: {e}")
+            return
+
+@contextlib.asynccontextmanager
+async def session_turn(session_id: str):
+    """Hold a session exclusively for one load/respond/save cycle, across workers when Redis is shared"""
+    # The in-process lock goes first, so each worker has at most one request waiting on Redis
+    async with get_session_lock(session_id):
+        if redis_client is None:
+            yield
+        else:
+            lock = redis_client.lock(
+                SESSION_LOCK_PREFIX + session_id,
+                timeout=SESSION_LOCK_TIMEOUT_SECONDS,
+                blocking_timeout=SESSION_LOCK_TIMEOUT_SECONDS,
+                thread_local=False
+            )
+            if not await lock.acquire():
+                raise LockError(f"Timed out waiting for session {session_id}")
+            renewal = asyncio.ensure_future(keep_lock(lock))
+            try:
+                yield
+            finally:
+                renewal.cancel()
+                # A client dropping /chat/stream cancels the response's task group, which
+                # re-cancels every await in it; unshielded, the release would never run
+                # and the session would stay locked until the lock expired
+                with anyio.CancelScope(shield=True):
+                    try:
+                        await lock.release()
+                    except LockError as e:
+                        # The turn itself finished; losing the lock is not the client's error
+                        print(f"Error releasing session lock {lock.name}: {e}")
+
+async def load_memory(session_id: str) -> WindowedMemory:
+    """Get a session's memory, refreshed from Redis when sessions are shared between workers"""
+    memory = get_memory(session_id)
+    if redis_client is not None:
+        stored = await redis_client.get(SESSION_KEY_PREFIX + session_id)
+        # Skip re-parsing when this worker wrote or last loaded the same history
+        if stored is None or stored != memory.stored:
+            memory.set_messages(messages_from_dict(orjson.loads(stored)) if stored else [], stored)
+    return memory
+
+async def save_turn(session_id: str, memory: WindowedMemory, message: str, reply: str) -> None:
+    """Record one user/assistant exchange, writing it through to Redis when configured"""
+    memory.save_context(
+        {"input": message},
+        {"output": reply}
+    )
+    if redis_client is not None:
+        memory.stored = orjson.dumps(messages_to_dict(memory.chat_memory.messages))
+        await redis_client.set(
+            SESSION_KEY_PREFIX + session_id,
+            memory.stored,
+            ex=SESSION_TTL_SECONDS
+        )
+
+def analysis_cache_key(concept: str, domain: str, language: str) -> str:
+    """Cache key that ignores case and whitespace differences in the request"""
+    return "\x1f".join(" ".join(part.split()).lower() for part in (concept, domain, language))
+
+async def get_cached_analysis(key: str) -> Optional[str]:
+    """Look up a cached analysis, in process first and then in Redis"""
+    analysis = analysis_cache.get(key)
+    if analysis is None and redis_client is not None:
+        stored = await redis_client.get(ANALYSIS_KEY_PREFIX + hashlib.sha256(key.encode()).hexdigest())
+        if stored is not None:
+            analysis = analysis_cache[key] = stored.decode()
+    return analysis
+
+async def cache_analysis(key: str, analysis: str) -> None:
+    """Remember an analysis for repeat requests"""
+    analysis_cache[key] = analysis
+    if redis_client is not None:
+        await redis_client.set(
+            ANALYSIS_KEY_PREFIX + hashlib.sha256(key.encode()).hexdigest(),
+            analysis,
+            ex=ANALYSIS_CACHE_TTL_SECONDS
+        )
+
+async def generate_analysis(cache_key: str, payload: Dict[str, str]) -> str:
+    """Produce a cleaned analysis, joining an identical one already in flight"""
+    task = analysis_in_flight.get(cache_key)
+    if task is None:
+        async def run() -> str:
+            response = await ainvoke_llm(get_analysis_chain(), payload)
+            # Clean any markdown that might appear
+            analysis = strip_markdown(response.content)
+            await cache_analysis(cache_key, analysis)
+            return analysis
+        
+        task = analysis_in_flight[cache_key] = asyncio.ensure_future(run())
+        task.add_done_callback(lambda _: analysis_in_flight.pop(cache_key, None))
+    # Shielded so one caller disconnecting doesn't cancel it for the others
+    return await asyncio.shield(task)
 
 def analyze_proof_complexity(function: str, args: List[str], custom_step_size: Optional[int] = None) -> Tuple[int, str]:
     """Analyze the computational complexity of a proof request"""
@@ -547,15 +1039,11 @@ def extract_proof_intent(message: str) -> Optional[Dict[str, Any]]:
     
     # LOCATION PATTERNS FIRST - highest priority
     if 'location' in message_lower:
-        cities = ['san francisco', 'sf', 'new york', 'nyc', 'london']
-        detected_city = None
-        for city in cities:
-            if city in message_lower:
-                detected_city = city
-                break
+        city_match = _RE_CITY.search(message_lower)
         
-        if detected_city:
-            device_match = re.search(r'device.*?(\d+)', message_lower)
+        if city_match:
+            detected_city = city_match.group(0)
+            device_match = _RE_DEVICE.search(message_lower)
             device_id = device_match.group(1) if device_match else str(random.randint(1000, 99999))
             
             return {
@@ -567,235 +1055,138 @@ def extract_proof_intent(message: str) -> Optional[Dict[str, Any]]:
     
     # Check for custom step size specification
     custom_step_size = None
-    step_size_patterns = [
-        r'(?:with\s+)?step\s+size\s+(\d+)',
-        r'(?:using\s+)?(\d+)\s+step\s+size',
-        r'step\s+(\d+)',
-    ]
-    
-    for pattern in step_size_patterns:
-        match = re.search(pattern, message_lower)
+    for pattern in _STEP_SIZE_PATTERNS:
+        match = pattern.search(message_lower)
         if match:
             custom_step_size = int(match.group(1))
             break
     
-    # Pattern matching for 3 main proof types
-    patterns = {
-        'prove_kyc': [
-            r'prove\s+kyc\s+compliance',
-            r'kyc\s+compliance',
-            r'verify\s+kyc\s+status',
-            r'prove\s+kyc',
-            r'kyc\s+proof',
-            r'kyc\s+verification',
-            r'circle\s+kyc',
-            r'regulatory\s+compliance',
-            r'compliance\s+proof',
-            r'kyc\s+approved',
-            r'prove\s+compliance'
-        ],
-        'prove_ai_content': [
-            r'prove\s+ai\s+content\s+authenticity',
-            r'ai\s+content\s+authenticity', 
-            r'verify\s+ai\s+content',
-            r'prove\s+content\s+authenticity',
-            r'ai\s+authenticity',
-            r'content\s+verification',
-            r'verify\s+ai\s+generated',
-            r'prove\s+ai\s+generated',
-            r'ai\s+content\s+proof',
-            r'authenticate\s+ai\s+content',
-            r'ai\s+content',
-            r'content\s+authenticity'
-        ]
-    }
-    
-    for func, func_patterns in patterns.items():
-        for pattern in func_patterns:
-            match = re.search(pattern, message_lower)
-            if match:
-                # Handle functions with no capture groups
-                if match.groups():
-                    args = list(match.groups())
-                else:
-                    # Set default arguments for each proof type
-                    if func == 'prove_kyc':
-                        args = ["12345", "1"]  # wallet_hash=12345, kyc_approved=1
-                    elif func == 'prove_ai_content':
-                        args = ["42", "1"]  # content_hash=42, auth_type=1
-                    else:
-                        args = []
-                
-                step_size, _ = analyze_proof_complexity(func, args, custom_step_size)
-                return {
-                    'function': func,
-                    'arguments': args,
-                    'step_size': step_size,
-                    'custom_step_size': custom_step_size is not None
-                }
+    for func, pattern in _RE_PROOF_TYPES.items():
+        if pattern.search(message_lower):
+            args = list(DEFAULT_PROOF_ARGS.get(func, []))
+            
+            step_size, _ = analyze_proof_complexity(func, args, custom_step_size)
+            return {
+                'function': func,
+                'arguments': args,
+                'step_size': step_size,
+                'custom_step_size': custom_step_size is not None
+            }
     
     return None
 
+# Canned replies for direct proof commands, formatted with the proof arguments
+PROOF_RESPONSE_TEMPLATES = {
+    'prove_kyc': "Generating a Circle KYC compliance proof for wallet hash {0} with KYC status {1} (1 = approved). "
+                 "The proof shows the wallet passed KYC without revealing any personal information.",
+    'prove_ai_content': "Generating an AI content authenticity proof for content hash {0} with authentication type {1}. "
+                        "The proof shows the content is authentic without exposing the content itself.",
+    'prove_location': "Generating a DePIN location proof for device {1} in {0}. "
+                      "The proof shows the device is inside the region without revealing its exact coordinates.",
+}
+
+def build_proof_intent(proof_intent: Dict[str, Any]) -> ProofIntent:
+    """Turn a pattern-matched proof intent into the structured ProofIntent response"""
+    step_size, complexity_reasoning = analyze_proof_complexity(
+        proof_intent['function'], 
+        proof_intent['arguments'],
+        proof_intent.get('step_size') if proof_intent.get('custom_step_size') else None
+    )
+    
+    explanation = f"Generating proof for {proof_intent['function']}({', '.join(proof_intent['arguments'])})"
+    if proof_intent.get('custom_step_size'):
+        explanation += f" with custom step size {step_size}"
+    
+    return ProofIntent(
+        function=proof_intent['function'],
+        arguments=proof_intent['arguments'],
+        step_size=step_size,
+        explanation=explanation,
+        complexity_reasoning=complexity_reasoning
+    )
+
+def render_proof_response(proof_intent: Dict[str, Any]) -> str:
+    """Templated reply for a proof command that needs no LLM elaboration"""
+    template = PROOF_RESPONSE_TEMPLATES.get(proof_intent['function'])
+    if template is None:
+        return build_proof_intent(proof_intent).explanation
+    return template.format(*proof_intent['arguments'])
+
+def route_chat(message: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Classify a chat message into its proof intent (if any) and route: template, analysis or conversation"""
+    # First, check if this might involve a proof or verification
+    lower_msg = message.lower()
+    
+    # Check for verification requests
+    is_verification = bool(_RE_VERIFICATION.search(lower_msg))
+    
+    # Check for proof-related content
+    proof_intent = extract_proof_intent(message)
+    
+    # Determine if additional context is requested
+    has_language_request = bool(_RE_LANGUAGE.search(lower_msg))
+    
+    has_analysis_request = bool(_RE_ANALYSIS.search(lower_msg))
+    
+    special_request = has_language_request or has_analysis_request or is_verification
+    
+    # Plain proof commands get a templated reply instead of an LLM round trip
+    if proof_intent and not special_request:
+        return proof_intent, "template"
+    if proof_intent or special_request:
+        return proof_intent, "analysis"
+    return None, "conversation"
+
+def chat_llm_call(message: str, history: List, analysis: bool) -> Tuple[Any, Any]:
+    """Pick the chain and input for an LLM-backed chat turn"""
+    return get_chat_chain(analysis), {
+        "input": message,
+        "history": history
+    }
+
 # ===== API ENDPOINTS =====
 
+@app.on_event("startup")
+async def preload_llm():
+    """Optionally pay the LLM import and client setup before the first request arrives"""
+    if LLM_PRELOAD:
+        get_chat_chain(True)
+        get_chat_chain(False)
+        get_analysis_chain()
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Process natural language and return structured proof intent with rich contextual response"""
     try:
-        memory = get_memory(request.session_id)
-        
-        # First, check if this might involve a proof or verification
-        lower_msg = request.message.lower()
+        session_id = request.session_id or "default"
+        proof_intent, route = route_chat(request.message)
         
-        # Check for verification requests
-        is_verification = any(word in lower_msg for word in ["verify", "check", "validate"])
-        
-        # Check for proof-related content
-        proof_intent = extract_proof_intent(request.message)
-        
-        # Determine if additional context is requested
-        has_language_request = any(lang in lower_msg for lang in [
-            "spanish", "español", "french", "français", "german", "deutsch",
-            "italian", "italiano", "portuguese", "português", "chinese", "中文",
-            "japanese", "日本語", "russian", "русский", "arabic", "عربي",
-            "persian", "farsi", "فارسی"
-        ])
-        
-        has_analysis_request = any(word in lower_msg for word in [
-            "explain", "market", "trends", "analysis", "significance",
-            "philosophy", "cultural", "economic", "business", "industry",
-            "what is", "tell me", "describe"
-        ])
-        
-        # If we have a proof intent OR special request, process with LLM
-        if proof_intent or has_language_request or has_analysis_request or is_verification:
-            # Build the enhanced prompt
-            enhanced_prompt = ChatPromptTemplate.from_messages([
-                ("system", SYSTEM_PROMPT),
-                MessagesPlaceholder(variable_name="history"),
-                ("human", "{input}"),
-                ("system", """Analyze this request carefully. The user said: "{input}"
-
-ABSOLUTELY CRITICAL: 
-- Use ONLY plain text
-- NO markdown formatting whatsoever
-- NO asterisks, hashtags, backticks, underscores, or any other formatting symbols
-- Write everything as simple, clean plain text
-
-If they're asking for a proof (kyc, ai content, location), extract these details:
-- Function name
-- Arguments
-- Provide a rich explanation in the language they requested
-
-If they're asking for verification:
-- Acknowledge the verification request
-- Explain what proof verification means
-- Let them know the system will verify the proof
-- DO NOT say you cannot verify proofs
-
-Always provide a conversational, helpful response that addresses ALL aspects of their request.
-If they ask in a specific language, respond in that language (except technical terms).""")
-            ])
-            
-            # Get conversation history
-            messages = memory.chat_memory.messages
+        # Turns for the same session run one at a time so concurrent requests can't lose history
+        async with session_turn(session_id):
+            memory = await load_memory(session_id)
             
-            # Create the prompt
-            prompt_value = enhanced_prompt.format_prompt(
-                input=request.message,
-                history=messages
-            )
-            
-            # Get LLM response
-            response = llm.invoke(prompt_value.to_messages())
-            response_content = response.content
-            
-            # Clean any remaining markdown that might slip through
-            response_content = re.sub(r'\*+', '', response_content)
-            response_content = re.sub(r'#+', '', response_content)
-            response_content = re.sub(r'`+', '', response_content)
-            response_content = re.sub(r'_+', '', response_content)
-            response_content = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', response_content)
-            
-            # Initialize response components
-            intent = None
-            requires_proof = False
-            main_response = response_content
-            
-            # If we detected a proof intent, create the structured intent
-            if proof_intent:
-                step_size, complexity_reasoning = analyze_proof_complexity(
-                    proof_intent['function'], 
-                    proof_intent['arguments'],
-                    proof_intent.get('step_size') if proof_intent.get('custom_step_size') else None
-                )
-                
-                explanation = f"Generating proof for {proof_intent['function']}({', '.join(proof_intent['arguments'])})"
-                if proof_intent.get('custom_step_size'):
-                    explanation += f" with custom step size {step_size}"
+            if route == "template":
+                main_response = render_proof_response(proof_intent)
+            else:
+                # Get LLM response for the conversation so far
+                runnable, payload = chat_llm_call(request.message, memory.chat_memory.messages, route == "analysis")
+                response = await ainvoke_llm(runnable, payload)
                 
-                intent = ProofIntent(
-                    function=proof_intent['function'],
-                    arguments=proof_intent['arguments'],
-                    step_size=step_size,
-                    explanation=explanation,
-                    complexity_reasoning=complexity_reasoning
-                )
-                requires_proof = True
+                # Clean any remaining markdown that might slip through
+                main_response = strip_markdown(response.content)
             
             # Save to memory
-            memory.save_context(
-                {"input": request.message},
-                {"output": main_response}
-            )
-            
-            return ChatResponse(
-                intent=intent,
-                response=main_response,
-                session_id=request.session_id,
-                requires_proof=requires_proof
-            )
+            await save_turn(session_id, memory, request.message, main_response)
         
-        else:
-            # For non-proof queries, still use LLM for natural conversation
-            conversation_prompt = ChatPromptTemplate.from_messages([
-                ("system", SYSTEM_PROMPT + "\n\nThe user is having a general conversation. Be helpful and conversational. Remember: NO markdown formatting whatsoever. Use only plain text."),
-                MessagesPlaceholder(variable_name="history"),
-                ("human", "{input}")
-            ])
-            
-            # Use invoke method
-            chain = conversation_prompt | llm
-            
-            # Get history
-            messages = memory.chat_memory.messages
-            
-            # Invoke the chain
-            response = chain.invoke({
-                "input": request.message,
-                "history": messages
-            })
-            
-            # Clean any markdown from response
-            cleaned_content = response.content
-            cleaned_content = re.sub(r'\*+', '', cleaned_content)
-            cleaned_content = re.sub(r'#+', '', cleaned_content)
-            cleaned_content = re.sub(r'`+', '', cleaned_content)
-            cleaned_content = re.sub(r'_+', '', cleaned_content)
-            cleaned_content = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', cleaned_content)
-            
-            # Save to memory
-            memory.save_context(
-                {"input": request.message},
-                {"output": cleaned_content}
-            )
-            
-            return ChatResponse(
-                intent=None,
-                response=cleaned_content,
-                session_id=request.session_id or "default",
-                requires_proof=False
-            )
+        # If we detected a proof intent, create the structured intent
+        intent = build_proof_intent(proof_intent) if proof_intent else None
+        
+        return ChatResponse(
+            intent=intent,
+            response=main_response,
+            session_id=session_id,
+            requires_proof=intent is not None
+        )
         
     except Exception as e:
         print(f"Error in chat endpoint: {e}")
@@ -810,29 +1201,78 @@ If they ask in a specific language, respond in that language (except technical t
             requires_proof=False
         )
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Stream the chat reply as server-sent events; a final "done" event carries the proof intent"""
+    session_id = request.session_id or "default"
+    proof_intent, route = route_chat(request.message)
+    intent = build_proof_intent(proof_intent) if proof_intent else None
+    
+    async def events():
+        try:
+            # Held until the turn is saved, like /chat
+            async with session_turn(session_id):
+                memory = await load_memory(session_id)
+                
+                if route == "template":
+                    reply = render_proof_response(proof_intent)
+                    yield sse_event({"content": reply})
+                else:
+                    runnable, payload = chat_llm_call(request.message, memory.chat_memory.messages, route == "analysis")
+                    parts = []
+                    async for text in stream_markdown_free(astream_llm(runnable, payload)):
+                        parts.append(text)
+                        yield sse_event({"content": text})
+                    reply = ''.join(parts)
+                
+                await save_turn(session_id, memory, request.message, reply)
+            
+            yield sse_event({
+                "intent": intent.model_dump() if intent else None,
+                "session_id": session_id,
+                "requires_proof": intent is not None
+            }, event="done")
+        except Exception as e:
+            print(f"Error in chat stream: {e}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event({"error": str(e)}, event="error")
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/sessions/{session_id}/history")
 async def get_history(session_id: str):
     """Get conversation history for a session"""
-    if session_id in memory_store:
-        memory = memory_store[session_id]
-        messages = memory.chat_memory.messages
-        return {
-            "session_id": session_id,
-            "messages": [
-                {
-                    "type": type(msg).__name__,
-                    "content": msg.content
-                }
-                for msg in messages
-            ]
-        }
-    return {"session_id": session_id, "messages": []}
+    # Read-only: never creates a session or restarts its idle timer (a TTLCache
+    # lookup doesn't), so polling history can't keep sessions alive or evict others
+    memory = memory_store.get(session_id)
+    if redis_client is not None:
+        stored = await redis_client.get(SESSION_KEY_PREFIX + session_id)
+        if stored is None:
+            messages = None
+        elif memory is not None and memory.stored == stored:
+            messages = memory.render_history()
+        else:
+            messages = render_messages(messages_from_dict(orjson.loads(stored)))
+    else:
+        messages = memory.render_history() if memory is not None else None
+    
+    if messages is None:
+        return {"session_id": session_id, "messages": []}
+    return Response(
+        content=b'{"session_id":' + orjson.dumps(session_id) + b',"messages":' + messages + b'}',
+        media_type="application/json"
+    )
 
 @app.delete("/sessions/{session_id}")
 async def clear_session(session_id: str):
     """Clear conversation history for a session"""
-    if session_id in memory_store:
-        del memory_store[session_id]
+    # Wait for any in-flight turn so it can't write the history back afterwards
+    async with session_turn(session_id):
+        if session_id in memory_store:
+            del memory_store[session_id]
+        if redis_client is not None:
+            await redis_client.delete(SESSION_KEY_PREFIX + session_id)
     return {"message": f"Session {session_id} cleared"}
 
 @app.get("/health")
@@ -862,37 +1302,21 @@ async def analyze_concept(request: Dict[str, str]):
     domain = request.get("domain", "general")
     language = request.get("language", "english")
     
-    analysis_prompt = ChatPromptTemplate.from_template("""
-    Analyze the concept: {concept}
-    Domain focus: {domain}
-    Response language: {language}
-    
-    CRITICAL: Use ONLY plain text. NO markdown formatting. No asterisks, hashtags, backticks, or any other formatting.
-    
-    Provide:
-    1. A clear explanation of the concept
-    2. How it relates to zkEngine proofs and zero-knowledge systems
-    3. Domain-specific insights ({domain})
-    4. Suggested proofs to demonstrate this concept
-    5. Real-world applications and implications
-    
-    Make the analysis engaging and accessible while maintaining technical accuracy.
-    If the language is not English, provide the entire response in {language}.
-    """)
-    
-    response = llm.invoke(analysis_prompt.format(
-        concept=concept,
-        domain=domain,
-        language=language
-    ))
-    
-    # Clean any markdown that might appear
-    cleaned_content = response.content
-    cleaned_content = re.sub(r'\*+', '', cleaned_content)
-    cleaned_content = re.sub(r'#+', '', cleaned_content)
-    cleaned_content = re.sub(r'`+', '', cleaned_content)
-    cleaned_content = re.sub(r'_+', '', cleaned_content)
-    cleaned_content = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', cleaned_content)
+    cache_key = analysis_cache_key(concept, domain, language)
+    cached = await get_cached_analysis(cache_key)
+    if cached is not None:
+        return {
+            "concept": concept,
+            "domain": domain,
+            "language": language,
+            "analysis": cached
+        }
+    
+    cleaned_content = await generate_analysis(cache_key, {
+        "concept": concept,
+        "domain": domain,
+        "language": language
+    })
     
     return {
         "concept": concept,
@@ -901,14 +1325,56 @@ async def analyze_concept(request: Dict[str, str]):
         "analysis": cleaned_content
     }
 
+@app.post("/analyze/stream")
+async def analyze_concept_stream(request: Dict[str, str]):
+    """Stream a concept analysis as server-sent events; a final "done" event echoes the request"""
+    concept = request.get("concept", "")
+    domain = request.get("domain", "general")
+    language = request.get("language", "english")
+    cache_key = analysis_cache_key(concept, domain, language)
+
+    async def events():
+        try:
+            cached = await get_cached_analysis(cache_key)
+            if cached is not None:
+                yield sse_event({"content": cached})
+            else:
+                payload = {
+                    "concept": concept,
+                    "domain": domain,
+                    "language": language
+                }
+                parts = []
+                async for text in stream_markdown_free(astream_llm(get_analysis_chain(), payload)):
+                    parts.append(text)
+                    yield sse_event({"content": text})
+                await cache_analysis(cache_key, ''.join(parts))
+
+            yield sse_event({
+                "concept": concept,
+                "domain": domain,
+                "language": language
+            }, event="done")
+        except Exception as e:
+            print(f"Error in analyze stream: {e}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event({"error": str(e)}, event="error")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 # ===== TRANSFORM SERVICE ENDPOINTS =====
 
+_NOOP_CHANGES = ("No transformation applied (auto_transform=False)",)
+
 @app.post("/api/transform-code", response_model=TransformResponse)
 async def transform_code(request: TransformRequest):
     """Transform C code to zkEngine-compatible format"""
     try:
         if request.auto_transform:
-            transformed_code, changes = transform_for_zkengine(request.code)
+            # The regex pass is CPU-bound on large sources, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            transformed_code, changes = await loop.run_in_executor(None, transform_for_zkengine, request.code)
             return TransformResponse(
                 success=True,
                 transformed_code=transformed_code,
@@ -918,7 +1384,7 @@ async def transform_code(request: TransformRequest):
             return TransformResponse(
                 success=True,
                 transformed_code=request.code,
-                changes=["No transformation applied (auto_transform=False)"]
+                changes=list(_NOOP_CHANGES)
             )
     except Exception as e:
         return TransformResponse(
@@ -953,35 +1419,43 @@ async def compile_transformed(request: CompileRequest):
         )
 
 # Upload interface endpoint (optional)
+# The upload page never changes, so encode it and its validators once
+UPLOAD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <title>zkEngine Code Upload</title>
+    <style>
+        body { font-family: Arial; margin: 40px; background: #0a0a0a; color: #e2e8f0; }
+        .container { max-width: 800px; margin: 0 auto; }
+        h1 { color: #c084fc; }
+        .info { background: rgba(139, 92, 246, 0.1); padding: 20px; border-radius: 8px; margin: 20px 0; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>zkEngine Code Upload</h1>
+        <div class="info">
+            <p>The upload functionality is integrated into the main UI.</p>
+            <p>Use the 📤 button next to the input field in the main interface.</p>
+            <p>Or use the 📋 paste button to paste C code directly.</p>
+        </div>
+        <a href="http://localhost:8001" style="color: #a78bfa;">← Back to Main Interface</a>
+    </div>
+</body>
+</html>
+"""
+_UPLOAD_HTML_BYTES = UPLOAD_HTML.encode('utf-8')
+_UPLOAD_HEADERS = {
+    'Cache-Control': 'public, max-age=3600',
+    'ETag': '"' + hashlib.blake2b(_UPLOAD_HTML_BYTES, digest_size=8).hexdigest() + '"'
+}
+
 @app.get("/upload")
-async def upload_interface():
+async def upload_interface(request: Request):
     """Simple upload interface for testing"""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>zkEngine Code Upload</title>
-        <style>
-            body { font-family: Arial; margin: 40px; background: #0a0a0a; color: #e2e8f0; }
-            .container { max-width: 800px; margin: 0 auto; }
-            h1 { color: #c084fc; }
-            .info { background: rgba(139, 92, 246, 0.1); padding: 20px; border-radius: 8px; margin: 20px 0; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>zkEngine Code Upload</h1>
-            <div class="info">
-                <p>The upload functionality is integrated into the main UI.</p>
-                <p>Use the 📤 button next to the input field in the main interface.</p>
-                <p>Or use the 📋 paste button to paste C code directly.</p>
-            </div>
-            <a href="http://localhost:8001" style="color: #a78bfa;">← Back to Main Interface</a>
-        </div>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+    if request.headers.get('if-none-match') == _UPLOAD_HEADERS['ETag']:
+        return Response(status_code=304, headers=_UPLOAD_HEADERS)
+    return Response(content=_UPLOAD_HTML_BYTES, media_type='text/html', headers=_UPLOAD_HEADERS)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,20 @@
+#!/usr/bin/env bash
+# Run the LangChain service with one worker process per core.
+# Workers only share chat sessions through Redis, so without REDIS_URL a single worker is started.
+set -euo pipefail
+cd "$(dirname "$0")"
+
+if [ -n "${REDIS_URL:-}" ]; then
+    CORES=$(nproc 2>/dev/null || sysctl -n hw.ncpu)
+    DEFAULT_WORKERS=$CORES
+else
+    echo "REDIS_URL is not set: starting a single worker so chat sessions stay consistent" >&2
+    DEFAULT_WORKERS=1
+fi
+
+exec uvicorn langchain_service:app \
+    --host 0.0.0.0 \
+    --port "${PYTHON_SERVICE_PORT:-8002}" \
+    --workers "${WEB_CONCURRENCY:-$DEFAULT_WORKERS}" \
+    --limit-concurrency "${LIMIT_CONCURRENCY:-200}" \
+    --timeout-keep-alive 5